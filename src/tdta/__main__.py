@@ -1,8 +1,5 @@
 import argparse
 import pathlib
-from tdta.purl_publish import publish_to_purl
-from tdta.tdt_export import export_cas_data
-from tdta.anndata_export import export_anndata
 
 
 def main():
@@ -15,14 +12,18 @@ def main():
 
     args = parser.parse_args()
 
+    # action modules are imported on demand to keep the cli startup light
     if args.action == "purl-publish":
+        from tdta.purl_publish import publish_to_purl
         publish_to_purl(str(args.input), str(args.taxonomy), str(args.user))
     elif args.action == "export":
+        from tdta.tdt_export import export_cas_data
         cache_folder_path = None
         if "cache" in args and args.cache:
             cache_folder_path = args.cache
         export_cas_data(args.database, args.output, cache_folder_path)
     elif args.action == "anndata":
+        from tdta.anndata_export import export_anndata
         cache_folder_path = None
         if "cache" in args and args.cache:
             cache_folder_path = args.cache
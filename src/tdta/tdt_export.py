@@ -1,20 +1,41 @@
 import os
 import sqlite3
-import ast
 import json
-from contextlib import closing
+import dataclasses
+import threading
 from pathlib import Path
 
 from tdta.utils import read_project_config
 from cas.model import (CellTypeAnnotation, Annotation, Labelset, AnnotationTransfer, UserAnnotation, AutomatedAnnotation)
-from cas.file_utils import write_json_file
 from cas.matrix_file.resolver import resolve_matrix_file
 from cas.populate_cell_ids import add_cell_ids
 
 CONFLICT_TBL_EXT = "_conflict"
 
+# tables are read in this order, 'annotation' must be read before 'annotation_transfer' that refers to it
 cas_table_names = ["annotation", "labelset", "metadata", "annotation_transfer"]
 
+# registered CAS tables that have a queryable view
+TABLE_NAMES_QUERY = ("SELECT t.\"table\" FROM table_view AS t WHERE t.\"table\" IN ({}) AND EXISTS "
+                     "(SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = t.\"table\" || '_view')")
+
+# CAS object lists that are serialized item by item
+STREAMED_CAS_FIELDS = ["annotations", "labelsets"]
+
+# indentation of the CAS json output
+JSON_INDENT = 2
+
+# field names of the CAS schema objects filled from the db rows
+schema_object_fields = {schema_class: frozenset(field.name for field in dataclasses.fields(schema_class))
+                        for schema_class in [CellTypeAnnotation, Annotation, Labelset, AnnotationTransfer,
+                                             AutomatedAnnotation]}
+
+# per-connection settings applied before reading the CAS tables
+CONNECTION_PRAGMAS = ["PRAGMA temp_store=memory", "PRAGMA cache_size=-64000"]
+
+# read connections reused by the exports running on the same thread
+thread_connections = threading.local()
+
 
 def export_cas_data(sqlite_db: str, output_file: str, dataset_cache_folder: str = None):
     """
@@ -25,16 +46,25 @@ def export_cas_data(sqlite_db: str, output_file: str, dataset_cache_folder: str
     """
     cta = CellTypeAnnotation("", list())
 
-    cas_tables = get_table_names(sqlite_db)
-    for table_name in cas_tables:
-        if table_name == "metadata":
-            parse_metadata_data(cta, sqlite_db, table_name)
-        elif table_name == "annotation":
-            parse_annotation_data(cta, sqlite_db, table_name)
-        elif table_name == "labelset":
-            parse_labelset_data(cta, sqlite_db, table_name)
-        elif table_name == "annotation_transfer":
-            parse__annotation_transfer_data(cta, sqlite_db, table_name)
+    sqlite_db = get_db_path(sqlite_db)
+    connection = get_connection(sqlite_db)
+    # read all tables in a single transaction to hold one shared lock and a consistent snapshot. Views are read with
+    # separate statements since their columns differ (no UNION ALL) and executescript doesn't return rows.
+    connection.execute("BEGIN")
+    try:
+        cas_tables = get_table_names(connection)
+        for table_name in [name for name in cas_table_names if name in cas_tables]:
+            if table_name == "metadata":
+                parse_metadata_data(cta, connection, table_name)
+            elif table_name == "annotation":
+                parse_annotation_data(cta, connection, table_name)
+            elif table_name == "labelset":
+                parse_labelset_data(cta, connection, table_name)
+            elif table_name == "annotation_transfer":
+                parse__annotation_transfer_data(cta, connection, table_name)
+    finally:
+        if connection.in_transaction:
+            connection.execute("COMMIT")
 
     project_config = read_project_config(Path(output_file).parent.absolute())
 
@@ -43,133 +73,239 @@ def export_cas_data(sqlite_db: str, output_file: str, dataset_cache_folder: str
         anndata = resolve_matrix_file(matrix_file_id, dataset_cache_folder)
         cas_json = add_cell_ids(cta.to_dict(), anndata)
         with open(output_file, "w") as json_file:
-            json.dump(cas_json, json_file, indent=2)
+            json.dump(cas_json, json_file, indent=JSON_INDENT)
     else:
         print("WARN: 'matrix_file_id' not specified in the project configuration. Skipping cell_id population")
-        write_json_file(cta, output_file, False)
+        write_cas_json(cta, output_file)
 
     print("CAS json successfully created at: {}".format(output_file))
     return cta
 
 
-def parse_metadata_data(cta, sqlite_db, table_name):
+def get_db_path(sqlite_db):
+    """
+    Normalizes the db file path, so that the same db file is identified by the same path in the caches.
+    :param sqlite_db: db file path
+    :return: absolute db file path without '.' and '..' segments
+    """
+    return os.path.abspath(sqlite_db)
+
+
+def get_connection(sqlite_db):
+    """
+    Returns the read-only connection of the current thread to the given db, so that consecutive exports reuse the
+    connection, its page cache and its prepared statements. A new connection is opened if the thread has none or has
+    one to another db file.
+    :param sqlite_db: db file path
+    :return: db connection
+    """
+    db_path = get_db_path(sqlite_db)
+    db_key = (db_path, os.stat(db_path).st_ino)
+    if getattr(thread_connections, "db_key", None) != db_key:
+        if getattr(thread_connections, "connection", None) is not None:
+            thread_connections.connection.close()
+        connection = sqlite3.connect(Path(db_path).as_uri() + "?mode=ro", uri=True)
+        connection.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            connection.execute(pragma)
+        thread_connections.connection = connection
+        thread_connections.db_key = db_key
+        thread_connections.table_names_version = None
+    return thread_connections.connection
+
+
+def write_cas_json(cta, output_file):
+    """
+    Writes the CAS object to the output json. Annotations and labelsets are converted to dicts and written one by one
+    while the json is streamed to the file, rather than serializing the whole CAS document in memory first. The output
+    is the same as 'write_json_file'.
+    :param cta: cell type annotation schema object.
+    :param output_file: output json path
+    """
+    cta.set_exclude_none_values(True)
+    streamed_fields = {field: getattr(cta, field) for field in STREAMED_CAS_FIELDS if getattr(cta, field) is not None}
+    cas_json = dataclasses.replace(cta, **{field: list() for field in streamed_fields}).to_dict()
+    encoder = json.JSONEncoder(indent=JSON_INDENT)
+    with open(output_file, "w") as json_file:
+        separator = "{"
+        for key, value in cas_json.items():
+            json_file.write(separator + "\n" + " " * JSON_INDENT + encoder.encode(key) + ": ")
+            separator = ","
+            if key in streamed_fields:
+                write_json_array(json_file, encoder, (obj.to_dict() for obj in streamed_fields[key]), 1)
+            else:
+                write_json_value(json_file, encoder, value, 1)
+        json_file.write("{}" if separator == "{" else "\n}")
+
+
+def write_json_array(json_file, encoder, values, level):
+    """
+    Writes the values to the json file as an array, encoding one item at a time.
+    :param json_file: output json file
+    :param encoder: json encoder
+    :param values: iterable of the array items
+    :param level: nesting level of the array in the json document
+    """
+    separator = "["
+    for value in values:
+        json_file.write(separator + "\n" + " " * JSON_INDENT * (level + 1))
+        separator = ","
+        write_json_value(json_file, encoder, value, level + 1)
+    json_file.write("[]" if separator == "[" else "\n" + " " * JSON_INDENT * level + "]")
+
+
+def write_json_value(json_file, encoder, value, level):
+    """
+    Writes the value to the json file chunk by chunk, indented to its nesting level in the json document.
+    :param json_file: output json file
+    :param encoder: json encoder
+    :param value: value to write
+    :param level: nesting level of the value in the json document
+    """
+    indent = "\n" + " " * JSON_INDENT * level
+    for chunk in encoder.iterencode(value):
+        # encoded strings escape their line breaks, so all line breaks are indentation
+        json_file.write(chunk.replace("\n", indent))
+
+
+def parse_metadata_data(cta, connection, table_name):
     """
     Reads 'Metadata' table data into the CAS object
     :param cta: cell type annotation schema object.
-    :param sqlite_db: db file path
+    :param connection: db connection
     :param table_name: name of the metadata table
     :return : True if metadata can be ingested, False otherwise
     """
-    with closing(sqlite3.connect(sqlite_db)) as connection:
-        with closing(connection.cursor()) as cursor:
-            rows = cursor.execute("SELECT * FROM {}_view".format(table_name)).fetchall()
-            columns = list(map(lambda x: x[0], cursor.description))
-            if len(rows) > 0:
-                auto_fill_object_from_row(cta, columns, rows[0])
-                return True
+    obj_fields = schema_object_fields[CellTypeAnnotation]
+    query = build_select_query(connection, table_name, lambda column: column in obj_fields or column == "message")
+    cursor = connection.execute(query)
+    row = cursor.fetchone()
+    columns = list(map(lambda x: x[0], cursor.description))
+    if row:
+        auto_fill_object_from_row(cta, columns, row)
+        return True
     return False
 
 
-def parse_annotation_data(cta, sqlite_db, table_name):
+def parse_annotation_data(cta, connection, table_name):
     """
     Reads 'Annotation' table data into the CAS object
     :param cta: cell type annotation schema object.
-    :param sqlite_db: db file path
+    :param connection: db connection
     :param table_name: name of the metadata table
     """
-    with closing(sqlite3.connect(sqlite_db)) as connection:
-        with closing(connection.cursor()) as cursor:
-            rows = cursor.execute("SELECT * FROM {}_view".format(table_name)).fetchall()
-            columns = list(map(lambda x: x[0], cursor.description))
-            if len(rows) > 0:
-                if not cta.annotations:
-                    annotations = list()
-                else:
-                    annotations = cta.annotations
-                for row in rows:
-                    annotation = Annotation("", "")
-                    auto_fill_object_from_row(annotation, columns, row)
-                    # handle user_annotations
-                    user_annotations = list()
-                    obj_fields = vars(annotation)
-                    for column in columns:
-                        if column not in obj_fields and column not in ["row_number", "message"]:
-                            user_annotations.append(UserAnnotation(column, str(row[columns.index(column)])))
-                    annotation.user_annotations = user_annotations
+    # all columns but the row number are consumed, as Annotation fields or user annotations
+    query = build_select_query(connection, table_name, lambda column: column != "row_number")
+    rows = connection.execute(query)
+    columns = list(map(lambda x: x[0], rows.description))
+    annotations = cta.annotations or list()
+    add_annotation = annotations.append
+    # columns that are not Annotation fields are user annotations, same for all rows
+    obj_fields = schema_object_fields[Annotation]
+    user_columns = [(index, column) for index, column in enumerate(columns)
+                    if column not in obj_fields and column not in ["row_number", "message"]]
+    for row in rows:
+        annotation = Annotation("", "")
+        auto_fill_object_from_row(annotation, columns, row)
+        # handle user_annotations, skipping the columns set on the annotation by the validation messages
+        obj_attributes = vars(annotation)
+        annotation.user_annotations = [UserAnnotation(column, str(row[index])) for index, column in user_columns
+                                       if column not in obj_attributes]
 
-                    annotations.append(annotation)
-                cta.annotations = annotations
+        add_annotation(annotation)
+    if annotations:
+        cta.annotations = annotations
 
 
-def parse_labelset_data(cta, sqlite_db, table_name):
+def parse_labelset_data(cta, connection, table_name):
     """
     Reads 'Labelset' table data into the CAS object
     :param cta: cell type annotation schema object.
-    :param sqlite_db: db file path
+    :param connection: db connection
     :param table_name: name of the metadata table
     """
-    with closing(sqlite3.connect(sqlite_db)) as connection:
-        with closing(connection.cursor()) as cursor:
-            rows = cursor.execute("SELECT * FROM {}_view".format(table_name)).fetchall()
-            columns = list(map(lambda x: x[0], cursor.description))
-            if len(rows) > 0:
-                if not cta.labelsets:
-                    labelsets = list()
-                else:
-                    labelsets = cta.labelsets
-                renamed_columns = [str(c).replace("automated_annotation_", "") for c in columns]
-                for row in rows:
-                    labelset = Labelset("", "")
-                    auto_fill_object_from_row(labelset, columns, row)
-                    # handle automated_annotation
-                    if row[renamed_columns.index("algorithm_name")]:
-                        automated_annotation = AutomatedAnnotation("", "", "", "")
-                        auto_fill_object_from_row(automated_annotation, renamed_columns, row)
-                        labelset.automated_annotation = automated_annotation
-                    labelsets.append(labelset)
-                cta.labelsets = labelsets
-
-
-def parse__annotation_transfer_data(cta, sqlite_db, table_name):
+    labelset_fields = schema_object_fields[Labelset]
+    automated_annotation_fields = schema_object_fields[AutomatedAnnotation]
+    query = build_select_query(connection, table_name,
+                               lambda column: column in labelset_fields or column == "message" or
+                               column.replace("automated_annotation_", "") in automated_annotation_fields)
+    rows = connection.execute(query)
+    columns = list(map(lambda x: x[0], rows.description))
+    labelsets = cta.labelsets or list()
+    add_labelset = labelsets.append
+    renamed_columns = [str(c).replace("automated_annotation_", "") for c in columns]
+    for row in rows:
+        labelset = Labelset("", "")
+        auto_fill_object_from_row(labelset, columns, row)
+        # handle automated_annotation
+        if row["automated_annotation_algorithm_name"]:
+            automated_annotation = AutomatedAnnotation("", "", "", "")
+            auto_fill_object_from_row(automated_annotation, renamed_columns, row)
+            labelset.automated_annotation = automated_annotation
+        add_labelset(labelset)
+    if labelsets:
+        cta.labelsets = labelsets
+
+
+def parse__annotation_transfer_data(cta, connection, table_name):
     """
     Reads 'Annotation Transfer' table data into the CAS object
     :param cta: cell type annotation schema object.
-    :param sqlite_db: db file path
+    :param connection: db connection
     :param table_name: name of the metadata table
     """
-    with closing(sqlite3.connect(sqlite_db)) as connection:
-        with closing(connection.cursor()) as cursor:
-            rows = cursor.execute("SELECT * FROM {}_view".format(table_name)).fetchall()
-            columns = list(map(lambda x: x[0], cursor.description))
-            if len(rows) > 0:
-                for row in rows:
-                    if "target_node_accession" in columns and row[columns.index("target_node_accession")]:
-                        filtered_annotations = [a for a in cta.annotations
-                                                if a.cell_set_accession == row[columns.index("target_node_accession")]]
-                        if filtered_annotations:
-                            at = AnnotationTransfer("", "", "", "", "")
-                            auto_fill_object_from_row(at, columns, row)
-                            if filtered_annotations[0].transferred_annotations:
-                                filtered_annotations[0].transferred_annotations.append(at)
-                            else:
-                                filtered_annotations[0].transferred_annotations = [at]
-
-
-def get_table_names(sqlite_db):
-    """
-    Queries 'table' table to get all CAS related table names
-    :param sqlite_db: db file path
+    transfer_fields = schema_object_fields[AnnotationTransfer]
+    query = build_select_query(connection, table_name, lambda column: column in transfer_fields or
+                               column in ["target_node_accession", "message"])
+    rows = connection.execute(query)
+    columns = list(map(lambda x: x[0], rows.description))
+    if "target_node_accession" not in columns:
+        return
+    annotations_by_accession = dict()
+    for annotation in cta.annotations or list():
+        annotations_by_accession.setdefault(annotation.cell_set_accession, annotation)
+    for row in rows:
+        if row["target_node_accession"]:
+            target_annotation = annotations_by_accession.get(row["target_node_accession"])
+            if target_annotation is not None:
+                at = AnnotationTransfer("", "", "", "", "")
+                auto_fill_object_from_row(at, columns, row)
+                if target_annotation.transferred_annotations:
+                    target_annotation.transferred_annotations.append(at)
+                else:
+                    target_annotation.transferred_annotations = [at]
+
+
+def build_select_query(connection, table_name, column_filter):
+    """
+    Builds the query that reads the view of the given table, selecting only the columns that are consumed.
+    :param connection: db connection
+    :param table_name: name of the table
+    :param column_filter: function that returns True if the given view column is consumed
+    :return: select query of the table view
+    """
+    view_columns = [row[1] for row in connection.execute("PRAGMA table_info(\"{}_view\")".format(table_name))]
+    columns = ["\"{}\"".format(column.replace("\"", "\"\"")) for column in view_columns if column_filter(column)]
+    return "SELECT {} FROM {}_view".format(", ".join(columns) or "*", table_name)
+
+
+def get_table_names(connection):
+    """
+    Queries 'table' table to get all CAS related table names. Tables without a '_view' are skipped, since their data
+    can't be read. Table names are cached with the connection of the current thread until another connection commits
+    to the db.
+    :param connection: db connection
     :return: list of CAS related table names
     """
-    cas_tables = list()
-    with closing(sqlite3.connect(sqlite_db)) as connection:
-        with closing(connection.cursor()) as cursor:
-            rows = cursor.execute("SELECT * FROM table_view").fetchall()
-            columns = list(map(lambda x: x[0], cursor.description))
-            table_column_index = columns.index('table')
-            for row in rows:
-                if str(row[table_column_index]) in cas_table_names:
-                    cas_tables.append(str(row[table_column_index]))
+    data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+    is_thread_connection = getattr(thread_connections, "connection", None) is connection
+    if is_thread_connection and getattr(thread_connections, "table_names_version", None) == data_version:
+        return list(thread_connections.table_names)
+    rows = connection.execute(TABLE_NAMES_QUERY.format(", ".join("?" * len(cas_table_names))), cas_table_names)
+    cas_tables = [str(row[0]) for row in rows]
+    if is_thread_connection:
+        thread_connections.table_names = tuple(cas_tables)
+        thread_connections.table_names_version = data_version
     return cas_tables
 
 
@@ -177,33 +313,34 @@ def auto_fill_object_from_row(obj, columns, row):
     """
     Automatically sets attribute values of the obj from the given db table row.
     :param obj: object to fill
-    :param columns: list of the db table columns
+    :param columns: list of the db table columns, in the order of the row values
     :param row: db record
     """
-    for column in columns:
-        if hasattr(obj, column):
-            value = row[columns.index(column)]
-            if value:
-                if isinstance(type(getattr(obj, column)), list):
-                    if value.strip().startswith("\"") and value.strip().endswith("\""):
-                        value = value.strip()[1:-1].strip()
-                    elif value.strip().startswith("'") and value.strip().endswith("'"):
-                        value = value.strip()[1:-1].strip()
-                    values = value.split("|")
-                    list_value = []
-                    for item in values:
-                        if item.strip().startswith("\"") and item.strip().endswith("\""):
-                            item = item.strip()[1:-1].strip()
-                        elif item.strip().startswith("'") and item.strip().endswith("'"):
-                            item = item.strip()[1:-1].strip()
-                        list_value.append(item)
-                    value = list_value
-                    # value = ast.literal_eval(value)
-                setattr(obj, column, value)
-        if 'message' in columns and row[columns.index('message')]:
-            # process invalid data
-            messages = json.loads(row[columns.index('message')])
-            for msg in messages:
-                if msg["column"] in columns:
-                    setattr(obj, msg["column"], msg["value"])
-
+    obj_fields = schema_object_fields.get(type(obj)) or vars(obj)
+    message = None
+    for column, value in zip(columns, row):
+        if column == "message":
+            message = value
+        if value and column in obj_fields:
+            if isinstance(type(getattr(obj, column)), list):
+                if value.strip().startswith("\"") and value.strip().endswith("\""):
+                    value = value.strip()[1:-1].strip()
+                elif value.strip().startswith("'") and value.strip().endswith("'"):
+                    value = value.strip()[1:-1].strip()
+                values = value.split("|")
+                list_value = []
+                for item in values:
+                    if item.strip().startswith("\"") and item.strip().endswith("\""):
+                        item = item.strip()[1:-1].strip()
+                    elif item.strip().startswith("'") and item.strip().endswith("'"):
+                        item = item.strip()[1:-1].strip()
+                    list_value.append(item)
+                value = list_value
+            setattr(obj, column, value)
+    if message:
+        # process invalid data
+        messages = json.loads(message)
+        column_names = set(columns)
+        for msg in messages:
+            if msg["column"] in column_names:
+                setattr(obj, msg["column"], msg["value"])
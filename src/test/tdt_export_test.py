@@ -1,12 +1,48 @@
 import unittest
 import os
 import shutil
-from tdta.tdt_export import export_cas_data
+import sqlite3
+import tempfile
+from unittest import mock
+from tdta.tdt_export import export_cas_data, write_cas_json, get_table_names, get_connection
+from cas.file_utils import write_json_file
+from cas.model import (CellTypeAnnotation, Annotation, Labelset, AnnotationTransfer, UserAnnotation,
+                       AutomatedAnnotation)
 
 TEST_DATA_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "./test_data/")
 TEST_OUTPUT = os.path.join(TEST_DATA_FOLDER, "cas_output.json")
 TEST_DB = os.path.join(TEST_DATA_FOLDER, "nanobot.db")
 
+TEST_DB_TABLE_PREFIX = "AIT115_annotation_sheet_"
+CAS_TABLES = ["annotation", "labelset", "metadata", "annotation_transfer"]
+
+
+def create_cas_db(folder, registered_tables=CAS_TABLES, views=CAS_TABLES, statements=()):
+    """
+    Creates a copy of the test db in the given folder where the CAS tables are registered with their plain names, along
+    with a project configuration without a 'matrix_file_id'.
+    :param folder: folder to create the db in
+    :param registered_tables: CAS tables to register in the 'table' table, in the given order
+    :param views: CAS tables to create a '_view' for
+    :param statements: additional sql statements to run on the db
+    :return: path of the created db
+    """
+    db_path = os.path.join(folder, "cas.db")
+    shutil.copyfile(TEST_DB, db_path)
+    with sqlite3.connect(db_path) as connection:
+        for index, table in enumerate(registered_tables):
+            connection.execute("INSERT INTO \"table\" (row_number, \"table\", path) VALUES (?, ?, '')",
+                               (100 + index, table))
+        for table in views:
+            connection.execute("CREATE VIEW \"{}_view\" AS SELECT * FROM \"{}{}_view\""
+                               .format(table, TEST_DB_TABLE_PREFIX, table))
+        for statement in statements:
+            connection.execute(statement)
+    connection.close()
+    with open(os.path.join(folder, "test_project_config.yaml"), "w") as config_file:
+        config_file.write("id: test\n")
+    return db_path
+
 
 class CASExportTests(unittest.TestCase):
     def setUp(self):
@@ -51,3 +87,187 @@ class CASExportTests(unittest.TestCase):
         self.assertEqual(12, len(test_annotation["user_annotations"]))
         self.assertTrue({'labelset': 'Cluster size', 'cell_label': '16393'} in test_annotation["user_annotations"])
         self.assertTrue({'labelset': 'region.info _Frequency_', 'cell_label': 'PuR(0.52) | CaH(0.39)'} in test_annotation["user_annotations"])
+
+
+class CASTableNameTests(unittest.TestCase):
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.output_folder, "cas.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_folder)
+
+    def test_table_without_view_skipped(self):
+        db = create_cas_db(self.output_folder, views=["annotation", "metadata", "annotation_transfer"])
+
+        table_names = get_table_names(get_connection(db))
+        self.assertEqual({"annotation", "metadata", "annotation_transfer"}, set(table_names))
+        result = export_cas_data(db, self.output_file).to_dict()
+        self.assertEqual(355, len(result["annotations"]))
+        self.assertFalse("labelsets" in result)
+        self.assertEqual("Nelson Johansen", result["author_name"])
+
+    def test_table_names_cached(self):
+        db = create_cas_db(self.output_folder)
+        table_names = get_table_names(get_connection(db))
+        self.assertEqual(set(CAS_TABLES), set(table_names))
+
+        statements = list()
+        get_connection(db).set_trace_callback(statements.append)
+        try:
+            same_db = os.path.join(self.output_folder, ".", "cas.db")
+            self.assertEqual(set(CAS_TABLES), set(get_table_names(get_connection(same_db))))
+            self.assertFalse([x for x in statements if "table_view" in x])
+        finally:
+            get_connection(db).set_trace_callback(None)
+
+    def test_table_names_cache_invalidated_on_db_change(self):
+        db = create_cas_db(self.output_folder, views=["annotation", "metadata", "annotation_transfer"])
+        connection = sqlite3.connect(db)
+        self.assertEqual("wal", connection.execute("PRAGMA journal_mode=WAL").fetchone()[0])
+        connection.close()
+        table_names = get_table_names(get_connection(db))
+        self.assertEqual({"annotation", "metadata", "annotation_transfer"}, set(table_names))
+        modified_time = os.path.getmtime(db)
+
+        with sqlite3.connect(db) as connection:
+            connection.execute("CREATE VIEW labelset_view AS SELECT * FROM {}labelset_view"
+                               .format(TEST_DB_TABLE_PREFIX))
+        self.assertEqual(modified_time, os.path.getmtime(db))
+        self.assertEqual(set(CAS_TABLES), set(get_table_names(get_connection(db))))
+        self.assertEqual(4, len(export_cas_data(db, self.output_file).labelsets))
+
+        connection.execute("DROP VIEW labelset_view")
+        connection.commit()
+        connection.close()
+        table_names = get_table_names(get_connection(db))
+        self.assertEqual({"annotation", "metadata", "annotation_transfer"}, set(table_names))
+        self.assertFalse("labelsets" in export_cas_data(db, self.output_file).to_dict())
+
+    def test_annotation_transfer_registered_first(self):
+        db = create_cas_db(self.output_folder, registered_tables=["annotation_transfer", "metadata", "labelset",
+                                                                  "annotation"],
+                           statements=["INSERT INTO {}annotation_transfer VALUES (2, 'AIT115_1', 'lbl', 'src', 'S_1', "
+                                       "'alg', 'comment')".format(TEST_DB_TABLE_PREFIX)])
+
+        result = export_cas_data(db, self.output_file).to_dict()
+        test_annotation = [x for x in result["annotations"] if x["cell_set_accession"] == "AIT115_1"][0]
+        self.assertEqual([{"transferred_cell_label": "lbl", "source_taxonomy": "src", "source_node_accession": "S_1",
+                           "algorithm_name": "alg", "comment": "comment"}], test_annotation["transferred_annotations"])
+
+
+class CASConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.output_folder, "cas.json")
+        self.db = create_cas_db(self.output_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_folder)
+
+    def test_connection_reused(self):
+        connection = get_connection(self.db)
+        export_cas_data(self.db, self.output_file)
+        export_cas_data(self.db, self.output_file)
+        self.assertIs(connection, get_connection(self.db))
+        self.assertIs(connection, get_connection(os.path.join(self.output_folder, ".", "cas.db")))
+
+    def test_connection_reopened_for_other_db(self):
+        connection = get_connection(self.db)
+        other_connection = get_connection(TEST_DB)
+        self.assertIsNot(connection, other_connection)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+        self.assertIsNot(other_connection, get_connection(self.db))
+
+    def test_connection_reopened_for_replaced_db(self):
+        connection = get_connection(self.db)
+        new_db = os.path.join(self.output_folder, "new.db")
+        shutil.copyfile(self.db, new_db)
+        os.replace(new_db, self.db)
+        self.assertIsNot(connection, get_connection(self.db))
+        self.assertEqual(355, len(export_cas_data(self.db, self.output_file).annotations))
+
+    def test_no_open_transaction_after_reader_error(self):
+        with mock.patch("tdta.tdt_export.parse_labelset_data", side_effect=ValueError("reader failure")):
+            with self.assertRaises(ValueError):
+                export_cas_data(self.db, self.output_file)
+        self.assertFalse(get_connection(self.db).in_transaction)
+        self.assertEqual(355, len(export_cas_data(self.db, self.output_file).annotations))
+
+    def test_export_relative_parent_path(self):
+        working_folder = os.path.join(self.output_folder, "sub")
+        os.mkdir(working_folder)
+        current_folder = os.getcwd()
+        os.chdir(working_folder)
+        try:
+            result = export_cas_data("../cas.db", "../cas.json").to_dict()
+        finally:
+            os.chdir(current_folder)
+        self.assertEqual(355, len(result["annotations"]))
+        self.assertEqual(4, len(result["labelsets"]))
+        self.assertTrue(os.path.exists(self.output_file))
+
+
+class CASUserAnnotationTests(unittest.TestCase):
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.output_folder, "cas.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_folder)
+
+    def test_user_annotations(self):
+        db = create_cas_db(self.output_folder)
+
+        result = export_cas_data(db, self.output_file).to_dict()
+        test_annotation = [x for x in result["annotations"] if x["cell_label"] == "1_MSN"][0]
+        self.assertEqual(12, len(test_annotation["user_annotations"]))
+        self.assertTrue({'labelset': 'Cluster size', 'cell_label': '16393'} in test_annotation["user_annotations"])
+        self.assertTrue({'labelset': 'Notes', 'cell_label': 'None'} in test_annotation["user_annotations"])
+
+    def test_user_column_with_message_skipped(self):
+        db = create_cas_db(self.output_folder,
+                           statements=["INSERT INTO message (\"table\", row, \"column\", value, level, rule, message) "
+                                       "VALUES ('{}annotation', 1, 'Notes', 'bad', 'error', 'rule', 'invalid')"
+                                       .format(TEST_DB_TABLE_PREFIX)])
+
+        result = export_cas_data(db, self.output_file).to_dict()
+        test_annotation = [x for x in result["annotations"] if x["cell_label"] == "1_MSN"][0]
+        self.assertEqual(11, len(test_annotation["user_annotations"]))
+        self.assertFalse("Notes" in [x["labelset"] for x in test_annotation["user_annotations"]])
+        other_annotation = [x for x in result["annotations"] if x["cell_label"] == "2_MSN"][0]
+        self.assertEqual(12, len(other_annotation["user_annotations"]))
+
+
+class CASJsonWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_folder)
+
+    def assert_same_as_write_json_file(self, cta):
+        expected_file = os.path.join(self.output_folder, "expected.json")
+        output_file = os.path.join(self.output_folder, "output.json")
+        write_json_file(cta, expected_file, False)
+        write_cas_json(cta, output_file)
+        with open(expected_file) as expected, open(output_file) as output:
+            self.assertEqual(expected.read(), output.read())
+
+    def test_write_populated_cas(self):
+        annotation = Annotation("Cluster", "1_MSN", cell_set_accession="AIT115_1",
+                                rationale="multi\nline \"rationale\" with ünicode")
+        annotation.user_annotations = [UserAnnotation("Cluster size", "16393"), UserAnnotation("Notes", "None")]
+        annotation.transferred_annotations = [AnnotationTransfer("lbl", "src", "S_1", "alg", None)]
+        parent = Annotation("Subclass", "D1-Matrix", cell_set_accession="AIT115_300", marker_gene_evidence=["A", "B"])
+        labelset = Labelset("Cluster", rank="0")
+        labelset.automated_annotation = AutomatedAnnotation("algo", "1", "", None)
+        cta = CellTypeAnnotation("Nelson Johansen", [annotation, parent], labelsets=[labelset, Labelset("Subclass")],
+                                 author_list=["a", "b"])
+
+        self.assert_same_as_write_json_file(cta)
+
+    def test_write_empty_cas(self):
+        self.assert_same_as_write_json_file(CellTypeAnnotation("", list()))
+        self.assert_same_as_write_json_file(CellTypeAnnotation("", list(), labelsets=list()))